@@ -1,3 +1,6 @@
+import bisect
+
+
 def approx_from_curve(x, curve):
     """
     Interpolates a point on a curve given by list of control points.
@@ -38,3 +41,59 @@ def approx_from_curve(x, curve):
 
     y = m*x+b
     return y
+
+
+def split_curve(curve):
+    """
+    Splits a curve into separate lists of its X and Y coordinates, as used by
+    approx_from_curve_cursor.
+
+    :param curve: Array of 2D (XY) points of shape (n,2)
+    :return: (x, y) lists of length n.
+    """
+    x = [float(point[0]) for point in curve]
+    y = [float(point[1]) for point in curve]
+    return x, y
+
+
+def approx_from_curve_cursor(x, curve_x, curve_y, cursor):
+    """
+    Same as approx_from_curve, but remembers between which two points of the
+    curve the argument was found. For arguments that change slowly from call
+    to call (eg. altitude during a simulation), the search will usually end at
+    the first check instead of going through the whole curve.
+
+    :param x: Argument
+    :param curve_x: X coordinates of the curve control points (ascending).
+    :param curve_y: Y coordinates of the curve control points.
+    :param cursor: Index returned by the previous call (pass 1 initially).
+    :return: (y, cursor)
+        y          Linear approximation for the given argument.
+        cursor     Index to be passed to the next call.
+    """
+
+    n = len(curve_x)
+
+    # If the input is outside the given range, output the extreme value.
+    if x > curve_x[n-1]:
+        return curve_y[n-1], cursor
+    elif x < curve_x[0]:
+        return curve_y[0], cursor
+
+    # Try the previously used pair of points and its neighbours first, find
+    # the right pair by bisection if the argument moved any further.
+    i = cursor
+    if not (0 < i < n and curve_x[i-1] <= x < curve_x[i]):
+        if 0 < i+1 < n and curve_x[i] <= x < curve_x[i+1]:
+            i = i+1
+        elif 0 < i-1 < n and curve_x[i-2] <= x < curve_x[i-1]:
+            i = i-1
+        else:
+            i = min(max(bisect.bisect_right(curve_x, x), 1), n-1)
+
+    # Linear function between those points, as in approx_from_curve.
+    m = (curve_y[i]-curve_y[i-1]) / (curve_x[i]-curve_x[i-1])
+    b = curve_y[i] - m*curve_x[i]
+
+    y = m*x+b
+    return y, i
@@ -1,11 +1,12 @@
+import math
 import numpy as np
 import init_simulation
 from launch_targeting import LaunchSite
 from results_to_init import InitStruct
 from unit import unit
+from vector_tools import norm3, norm3_fast, dot3, cross3, normalize3
 from get_angle_from_frame import get_angle_from_frame
-from approx_from_curve import approx_from_curve
-from get_max_value import get_max_value
+from approx_from_curve import approx_from_curve, approx_from_curve_cursor, split_curve
 from get_orbital_elements import get_orbital_elements
 from get_thrust import get_thrust
 from rodrigues import rodrigues
@@ -18,24 +19,56 @@ R = init_simulation.R
 atmpressure = init_simulation.atmpressure
 atmtemperature = init_simulation.atmtemperature
 period = init_simulation.period
-convergence_criterion = init_simulation.convergence_criterion
+CONVERGENCE_CRITERION = init_simulation.convergence_criterion  # default UPFG convergence tolerance
+OMEGA_R = 2*np.pi*R/period  # Earth's rotation velocity at the equator [m/s]
+
+# Whether debug_aggregator should archive all of the UPFG debug output. If not,
+# only the data needed by the simulation itself (time, tgo, divergence flag)
+# is kept.
+DEBUG_FULL = False
+# Whether converge_upfg should report successful convergence (failures are
+# always reported).
+DEBUG_UPFG = False
 
 
 # Helper function (built into MATLAB) -- note that elevation is not theta
 def cart2sph(x, y, z):
     xxyy = x**2 + y**2
-    r = np.sqrt(xxyy + z**2)
-    elevation = np.arctan2(z, np.sqrt(xxyy))
-    azimuth = np.arctan2(y, x)
-    return np.array([azimuth, elevation, r])
+    r = math.sqrt(xxyy + z**2)
+    elevation = math.atan2(z, math.sqrt(xxyy))
+    azimuth = math.atan2(y, x)
+    return azimuth, elevation, r
+
+
+# Same as cart2sph, for an array of XYZ points of shape (n,3); returns an
+# array of (azimuth, elevation, r) rows
+def cart2sph_vec(xyz):
+    xyz = np.asarray(xyz, dtype=float)
+    xxyy = xyz[:, 0]**2 + xyz[:, 1]**2
+    sph = np.empty(xyz.shape)
+    sph[:, 0] = np.arctan2(xyz[:, 1], xyz[:, 0])
+    sph[:, 1] = np.arctan2(xyz[:, 2], np.sqrt(xxyy))
+    sph[:, 2] = np.sqrt(xxyy + xyz[:, 2]**2)
+    return sph
 
 
 # Helper function (built into MATLAB)
 def sph2cart(azimuth, elevation, r):
-    x = r * np.cos(elevation) * np.cos(azimuth)
-    y = r * np.cos(elevation) * np.sin(azimuth)
-    z = r * np.sin(elevation)
-    return np.array([x, y, z])
+    x = r * math.cos(elevation) * math.cos(azimuth)
+    y = r * math.cos(elevation) * math.sin(azimuth)
+    z = r * math.sin(elevation)
+    return x, y, z
+
+
+# Latitude (elevation in cart2sph) of an XYZ vector, without the rest of the
+# spherical coordinates
+def _latitude(r):
+    x, y, z = r.tolist()
+    return math.atan2(z, math.sqrt(x*x + y*y))
+
+
+# unit vector along the Earth's rotation axis
+_Z_AXIS = np.array([0.0, 0.0, 1.0])
 
 
 class Orbit:
@@ -124,21 +157,6 @@ class CoastControl(Control):
         self.length = length
 
 
-class GrowingList(list):
-    def __init__(self, default=None):
-        self.default = default
-
-    def __setitem__(self, index, value):
-        if index >= len(self):
-            self.extend([self.default]*(index + 1 - len(self)))
-        list.__setitem__(self, index, value)
-
-    def __getitem__(self, index):
-        if index >= len(self):
-            return self.default
-        return list.__getitem__(self, index)
-
-
 def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance_func=None, get_state_func=None):
     """
     Complete 3DoF flight simulation in Cartesian coordinates.
@@ -185,6 +203,7 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
     engines = vehicle[stage].engines
     area = vehicle[stage].area
     drag = vehicle[stage].drag
+    drag_x, drag_y = split_curve(drag)
     
     # DETERMINE SIMULATION LENGTH
     # Set a desired simulation length for a coast phase. For powered phases,
@@ -196,55 +215,61 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
         maxT = vehicle[stage].maxT
     
     # SIMULATION SETUP
-    # n = int(np.floor(maxT/dt)+1)    # simulation steps
-    t = GrowingList(0)              # simulation time
-    F = GrowingList(0)              # thrust magnitude [N]
-    acc = GrowingList(0)            # acceleration due to thrust magnitude [m/s^2]
-    q = GrowingList(0)              # dynamic pressure [Pa]
-    pitch = GrowingList(0)          # pitch command log [deg] (0 - straight up)
-    yaw = GrowingList(0)            # yaw command log [deg] (0 - straight East, 90 - North)
+    # All logs are preallocated for the nominal number of steps (plus some
+    # margin); they only need to grow if the real time steps turn out shorter.
+    n = int(np.floor(maxT/dt)) + 8  # simulation steps
+    t = np.zeros(n)                 # simulation time
+    F = np.zeros(n)                 # thrust magnitude [N]
+    acc = np.zeros(n)               # acceleration due to thrust magnitude [m/s^2]
+    q = np.zeros(n)                 # dynamic pressure [Pa]
+    pitch = np.zeros(n)             # pitch command log [deg] (0 - straight up)
+    yaw = np.zeros(n)               # yaw command log [deg] (0 - straight East, 90 - North)
     g_loss = 0                      # gravity d-v losses [m/s]
     d_loss = 0                      # drag d-v losses [m/s]
     # vehicle position in cartesian XYZ frame
-    r = GrowingList(np.array([0, 0, 0]))     # from Earth's center [m]
-    rmag = GrowingList(0)                    # magnitude [m]
+    r = np.zeros((n, 3))            # from Earth's center [m]
+    rmag = np.zeros(n)              # magnitude [m]
     # vehicle velocity
-    v = GrowingList(np.array([0, 0, 0]))     # relative to Earth's center [m/s]
-    vmag = GrowingList(0)                    # magnitude [m/s]
-    vy = GrowingList(0)                      # magnitude - altitude change [m/s]
-    vt = GrowingList(0)                      # magnitude - tangential [m/s]
-    vair = GrowingList(np.array([0, 0, 0]))  # relative to surface [m/s]
-    vairmag = GrowingList(0)                 # magnitude relative to surface [m/s]
+    v = np.zeros((n, 3))            # relative to Earth's center [m/s]
+    vmag = np.zeros(n)              # magnitude [m/s]
+    vy = np.zeros(n)                # magnitude - altitude change [m/s]
+    vt = np.zeros(n)                # magnitude - tangential [m/s]
+    vair = np.zeros((n, 3))         # relative to surface [m/s]
+    vairmag = np.zeros(n)           # magnitude relative to surface [m/s]
     # reference frame matrices
-    nav = [np.array([0, 0, 0])]*3  # KSP-style navball frame (radial, North, East)
-    rnc = [np.array([0, 0, 0])]*3  # PEG-style tangential frame (radial, normal, circumferential)
+    # (both are rewritten in place at each step)
+    nav = np.zeros((3, 3))         # KSP-style navball frame (radial, North, East)
+    rnc = np.zeros((3, 3))         # PEG-style tangential frame (radial, normal, circumferential)
+    acv = np.zeros(3)              # acceleration due to thrust [m/s^2]
+    thrust_pitch = np.nan          # pitch and yaw the thrust direction was last computed for
+    thrust_yaw = np.nan
     # flight angles
-    ang_p_srf = GrowingList(0)     # flight pitch angle, surface related
-    ang_y_srf = GrowingList(0)     # flight yaw angle, surface related
-    ang_p_obt = GrowingList(0)     # flight pitch angle, orbital (absolute)
-    ang_y_obt = GrowingList(0)     # flight yaw angle, orbital (absolute)
+    ang_p_srf = np.zeros(n)        # flight pitch angle, surface related
+    ang_y_srf = np.zeros(n)        # flight yaw angle, surface related
+    ang_p_obt = np.zeros(n)        # flight pitch angle, orbital (absolute)
+    ang_y_obt = np.zeros(n)        # flight yaw angle, orbital (absolute)
+    # curve lookups, each keeping track of where the previous step found its value
+    atmpressure_x, atmpressure_y = split_curve(atmpressure)
+    atmtemperature_x, atmtemperature_y = split_curve(atmtemperature)
+    cur_p = 1
+    cur_T = 1
+    cur_cd = 1
     dbg = None
     upfg_internal = None
     # SIMULATION INITIALIZATION
-    if isinstance(initial, LaunchSite):     # launch from static site
-        r[0] = sph2cart(np.deg2rad(initial.longitude), np.deg2rad(initial.latitude), R+initial.altitude)
-        nav = get_navball_frame(r[0])
-        v[0] = surf_speed(r[0], nav)
-    elif isinstance(initial, InitStruct):   # vehicle already in flight
-        t[0] = initial.t
-        r[0] = initial.r
-        v[0] = initial.v
-    else:
+    conditions = _initial_conditions(initial)
+    if conditions is None:
         print('Wrong initial conditions!')
         return None
-    rmag[0] = np.linalg.norm(r[0])
-    vmag[0] = np.linalg.norm(v[0])
-    nav = get_navball_frame(r[0])
-    rnc = get_circum_frame(r[0], v[0])
+    t[0], r[0], v[0] = conditions
+    rmag[0] = norm3_fast(r[0])
+    vmag[0] = norm3_fast(v[0])
+    get_navball_frame(r[0], nav)
+    get_circum_frame(r[0], v[0], rnc)
     vair[0] = v[0] - surf_speed(r[0], nav)
-    vairmag[0] = max(np.linalg.norm(vair[0]), 1)
-    vy[0] = np.vdot(v[0], nav[0])
-    vt[0] = np.vdot(v[0], rnc[2])
+    vairmag[0] = max(norm3_fast(vair[0]), 1)
+    vy[0] = dot3(v[0], nav[0])
+    vt[0] = dot3(v[0], rnc[2])
     ang_p_srf[0] = get_angle_from_frame(vair[0], nav, 'pitch')
     ang_y_srf[0] = get_angle_from_frame(vair[0], nav, 'yaw')
     ang_p_obt[0] = get_angle_from_frame(v[0], nav, 'pitch')
@@ -253,6 +278,13 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
     p = approx_from_curve((rmag[0]-R)/1000, atmpressure)
     temp, _, _ = get_thrust(engines, p, t[0])
     acc[0] = temp / m
+    # Minor jettison events left for this phase, ordered by time. Events
+    # scheduled for a previous burn phase (their time set before the current
+    # phase begun, or to negative once executed) are left out - otherwise all
+    # older jettisons would be repeated in this phase.
+    jet_order = sorted([j for j in range(len(jettison)) if jettison[j][0] >= t[0]],
+                       key=lambda j: jettison[j][0])
+    jet_next = 0  # index into jet_order of the next event to execute
     eng = 1     # engine state flag (other value signifies some error):
                 # 0 - fuel deprived;
                 # 1 - running;
@@ -260,7 +292,8 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
                 # 3 - cut exceptionally by a velocity limit
     
     # CONTROL SETUP
-    if control.type == 0:       # natural gravity turn
+    control_type = control.type
+    if control_type == 0:       # natural gravity turn
         gtiP = control.pitch    # initial pitchover angle for gravity turn
         gtiV = control.velocity # velocity at which the pitchover begins
         azim = control.azimuth  # launch azimuth
@@ -268,63 +301,53 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
                 # 0 - not begun yet;
                 # 1 - equaling to flight angle;
                 # 2 - match flight angle
-    elif control.type == 1:     # pitch program control, constant azimuth
-        prog = control.program
+    elif control_type == 1:     # pitch program control, constant azimuth
+        prog_x, prog_y = split_curve(control.program)
+        cur_prog = 1
         azim = control.azimuth
-    elif control.type == 2:     # deprecated PEG mode
+    elif control_type == 2:     # deprecated PEG mode
         print('Powered Explicit Guidance mode for 3D simulation is deprecated! Use UPFG instead (type 3).')
         return None
-    elif control.type == 3:     # Unified Powered Flight Guidance
+    elif control_type == 3:     # Unified Powered Flight Guidance
         target = control.target
+        target_velocity = target.velocity
         ct = control.major      # cycle time (UPFG will be called that often)
         lc = 0                  # last call was that long ago
+        upfg_vehicle = vehicle[stage:]  # current and all further stages
         # Create internal states for UPFG - continue from last stage if
-        # possible. First create physical state and CSE state structs, as
-        # well as the debug information container.
+        # possible. First create physical state struct, as well as the debug
+        # information container, then converge the guidance.
         upfg_state = upfg.State(t[0], m, r[0], v[0])
-        cser = upfg.CSERState(0, 0, 0, 0, 0)
-        dbg = debug_initializator(int(np.floor(maxT/ct)))
-        # Then check if the stage continues an already started UPFG routine.
-        # If so, verify if the routine contains necessary fields (just
-        # checks for 'tgo', assuming an erroneous struct will be empty or
-        # contain just garbage).
-        if isinstance(initial, InitStruct) and initial.upfg is not None \
-            and isinstance(initial.upfg, upfg.UPEGState):
-            # If the struct is okay, use it as initialization for the
-            # current stage and reconverge UPFG. This helps avoid some
-            # guidance oscillation after coast phases.
-            upfg_internal = initial.upfg
-            upfg_internal.tb = 0
-            upfg_internal, guidance, debug = converge_upfg(vehicle[stage:len(vehicle)],
-                                                           target, upfg_state, upfg_internal,
-                                                           0, 50)
-        # If no initial state was found, a new one must be built and converged.
-        if upfg_internal is None:
-            # Guidance initialization: project initial position direction unit
-            # vector onto target plane, rotate with Rodrigues' formula about
-            # 20 degrees prograde and extend to target length, finally calculate
-            # velocity at this point.
-            rdinit = rodrigues(unit(r[0]), -target.normal, 20)
-            rdinit = rdinit * target.radius
-            vdinit = target.velocity*unit(np.cross(-target.normal, rdinit))
-            vdinit = vdinit - v[0]
-            upfg_internal = upfg.UPEGState(cser, np.array([0, 0, 0]), rdinit, 
-                                           -(mu/2)*r[0]/np.linalg.norm(r[0])**3,
-                                           0, t[0], 0, v[0], vdinit)
-            upfg_internal, guidance, debug = converge_upfg(vehicle[stage:len(vehicle)],
-                                                           target, upfg_state, upfg_internal,
-                                                           t[0], 50)
+        dbg = debug_initializator(int(np.floor(maxT/ct)) + 5)
+        upfg_internal, guidance, debug = _init_upfg(upfg_vehicle, target, upfg_state, initial)
         dbg = debug_aggregator(dbg, debug)
         pitch[0] = guidance.pitch
         yaw[0] = guidance.yaw
-    elif control.type == 5:    # coast phase (unguided free flight)
+    elif control_type == 5:    # coast phase (unguided free flight)
         acc[0] = 0
         eng = -1
     
     # SIMULATION MAIN LOOP
-    for i in xrange(1, 1000000):  # arbitrary limit to avoid exhausting memory
+    # Runs until the phase duration is exceeded or one of the break conditions
+    # (cutoff, crash) is met; i is the step being computed.
+    i = 0
+    while True:
+        i = i + 1
+        # Steps measured by get_state_func can be shorter than the nominal dt,
+        # in which case the logs run out of room and have to be enlarged.
+        if i == n:
+            n = 2*n
+            t, F, acc, q, pitch, yaw, r, rmag, v, vmag, vy, vt, vair, vairmag, \
+                ang_p_srf, ang_y_srf, ang_p_obt, ang_y_obt = \
+                _grow(n, t, F, acc, q, pitch, yaw, r, rmag, v, vmag, vy, vt, vair, vairmag,
+                      ang_p_srf, ang_y_srf, ang_p_obt, ang_y_obt)
+        # rows of the 3-vector logs for the previous and the current step
+        # (views into the contiguous logs, so no data is copied)
+        r_prev, r_i = r[i-1], r[i]
+        v_prev, v_i = v[i-1], v[i]
+        vair_prev, vair_i = vair[i-1], vair[i]
         # GUIDANCE
-        if control.type == 0:    # natural gravity turn
+        if control_type == 0:    # natural gravity turn
             # First if-set controls current state - initial is GT==0 which
             # means vehicle is going straight up, building speed. GT==1
             # means it's going fast enough to start pitching over in the
@@ -332,27 +355,33 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
             # and is waiting for velocity vector to align with it. GT==2
             # means velocity vector has aligned and vehicle will hold the
             # prograde direction.
-            if vy[i-1] >= gtiV and GT == 0:
-                GT = 1
-            elif ang_p_srf[i-1] > gtiP and GT == 1:
-                GT = 2
-            # Second if-set controls what to do depending on current state.
-            # For GT==0 do nothing, just go straight up. For GT==1 pitch
-            # over to the given angle at a constant rate of 1deg/s, hold the
-            # given pitch after reaching it. For GT==2 just hold prograde.
-            if GT == 0:
-                pitch[i] = 0
-                yaw[i] = azim
-            elif GT == 1:
-                pitch[i] = min(pitch[i-1]+dt, gtiP)
-                yaw[i] = azim
-            else:
+            # GT==2 is final and lasts for most of the phase, so it is
+            # handled first, without going through the state transitions.
+            if GT == 2:
                 pitch[i] = ang_p_srf[i-1]
                 yaw[i] = azim
-        elif control.type == 1:  # pitch program control, constant azimuth
-            pitch[i] = approx_from_curve(t[i-1], prog)
+            else:
+                if vy[i-1] >= gtiV and GT == 0:
+                    GT = 1
+                elif ang_p_srf[i-1] > gtiP and GT == 1:
+                    GT = 2
+                # Second if-set controls what to do depending on current state.
+                # For GT==0 do nothing, just go straight up. For GT==1 pitch
+                # over to the given angle at a constant rate of 1deg/s, hold the
+                # given pitch after reaching it. For GT==2 just hold prograde.
+                if GT == 0:
+                    pitch[i] = 0
+                    yaw[i] = azim
+                elif GT == 1:
+                    pitch[i] = min(pitch[i-1]+dt, gtiP)
+                    yaw[i] = azim
+                else:
+                    pitch[i] = ang_p_srf[i-1]
+                    yaw[i] = azim
+        elif control_type == 1:  # pitch program control, constant azimuth
+            pitch[i], cur_prog = approx_from_curve_cursor(t[i-1], prog_x, prog_y, cur_prog)
             yaw[i] = azim
-        elif control.type == 3:  # Unified Powered Flight Guidance
+        elif control_type == 3:  # Unified Powered Flight Guidance
             # Check if the current stage ran out of fuel (ie. if the current
             # phase exceeded its maximum burn time).
             if t[i-1]-t[0] > maxT and eng > 0:
@@ -366,11 +395,11 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
                 # Update struct holding the vehicle's physical state
                 upfg_state.time     = t[i-1]
                 upfg_state.mass     = m
-                upfg_state.radius   = r[i-1]
-                upfg_state.velocity = v[i-1]
+                upfg_state.radius   = r_prev
+                upfg_state.velocity = v_prev
                 # Call UPFG and collect the debug output
                 upfg_internal, guidance, debug = upfg.unified_powered_flight_guidance(
-                               vehicle[stage:len(vehicle)],
+                               upfg_vehicle,
                                target, upfg_state, upfg_internal)
                 dbg = debug_aggregator(dbg, debug)
                 # The following 6 lines were meant to handle UPFG divergence
@@ -388,7 +417,7 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
                 break
             # Safety cutoff in case UPFG went crazy. Will cut off when
             # absolute target velocity is reached.
-            if np.linalg.norm(v[i-1]) >= target.velocity:
+            if norm3_fast(v_prev) >= target_velocity:
                 eng = 3
                 break
             # Update current pitch and yaw commands (TODO: incorporate angle
@@ -404,8 +433,9 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
         desired_throttle = 0.0
         # Thrust: zero for coast flight, different calculations for constant
         # thrust and constant acceleration modes.
-        p = approx_from_curve((rmag[i-1]-R)/1000, atmpressure)
-        if control.type == 5:
+        alt = (rmag[i-1]-R)/1000  # altitude [km] for the atmosphere curves
+        p, cur_p = approx_from_curve_cursor(alt, atmpressure_x, atmpressure_y, cur_p)
+        if control_type == 5:
             F[i] = 0
             dm = 0
         else:
@@ -421,61 +451,67 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
             else:
                 desired_throttle = 1.0
         acc[i] = F[i]/m
-        acv = acc[i]*make_vector(nav, pitch[i], yaw[i])
+        # Thrust direction (see make_vector). Commanded angles are often held
+        # for many steps, the trigonometry is only redone when they change.
+        if pitch[i] != thrust_pitch or yaw[i] != thrust_yaw:
+            thrust_pitch = pitch[i]
+            thrust_yaw = yaw[i]
+            thrust_coefficients = _make_vector_coefficients(thrust_pitch, thrust_yaw)
+        _frame_combination(nav, thrust_coefficients, acv)
+        acv *= acc[i]
         # gravity
-        G = mu*r[i-1]/rmag[i-1]**3                    # acceleration [m/s^2]
-        g_loss = g_loss + np.linalg.norm(G)*dt        # integrate gravity losses
+        G = mu*r_prev/rmag[i-1]**3                    # acceleration [m/s^2]
+        g_loss = g_loss + norm3_fast(G)*dt            # integrate gravity losses
         # drag
-        cd = approx_from_curve(vairmag[i-1], drag)    # drag coefficient
-        temp = approx_from_curve((rmag[i-1]-R)/1000, atmtemperature)+273.15
-        dens = calculate_air_density(p*101325, temp)  # constant is pascals per atm
-        q[i] = 0.5*dens*vairmag[i-1]**2               # dynamic pressure
-        D = area*cd*q[i]/m                            # drag-induced acceleration [m/s^2]
-        d_loss = d_loss + D*dt                        # integrate drag losses
+        if p == 0:
+            # Vacuum (above the top of the pressure curve) - no drag, so skip
+            # the remaining lookups.
+            q[i] = 0
+            D = 0
+        else:
+            cd, cur_cd = approx_from_curve_cursor(vairmag[i-1], drag_x, drag_y, cur_cd)  # drag coefficient
+            temp, cur_T = approx_from_curve_cursor(alt, atmtemperature_x, atmtemperature_y, cur_T)
+            temp = temp+273.15
+            dens = calculate_air_density(p*101325, temp)  # constant is pascals per atm
+            q[i] = 0.5*dens*vairmag[i-1]**2               # dynamic pressure
+            D = area*cd*q[i]/m                            # drag-induced acceleration [m/s^2]
+            d_loss = d_loss + D*dt                        # integrate drag losses
         if get_state_func is not None:
             # Get the actual values, instead of predicting them
-            r[i], v[i], m, t[i] = get_state_func()
+            r_i[:], v_i[:], m, t[i] = get_state_func()
         else:
             # Forecast values
-            v[i] = v[i-1] + acv*dt - G*dt - D*unit(vair[i-1])*dt
-            r[i] = r[i-1] + v[i]*dt
+            _integrate_step(r_prev, v_prev, acv, G, D, vair_prev, dt, r_i, v_i)
             m = m - dm*dt
             t[i] = t[i-1] + dt
         # absolute velocities
-        vmag[i] = np.linalg.norm(v[i])
-        vy[i] = np.vdot(v[i], nav[0])
-        vt[i] = np.vdot(v[i], rnc[2])
+        vmag[i] = norm3_fast(v_i)
+        vy[i] = dot3(v_i, nav[0])
+        vt[i] = dot3(v_i, rnc[2])
         # position
-        rmag[i] = np.linalg.norm(r[i])
+        rmag[i] = norm3_fast(r_i)
         # local reference frames
-        nav = get_navball_frame(r[i])
-        rnc = get_circum_frame(r[i], v[i])
+        get_navball_frame(r_i, nav)
+        get_circum_frame(r_i, v_i, rnc)
         # surface velocity (must be here because needs reference frames)
-        vair[i] = v[i] - surf_speed(r[i], nav)
-        vairmag[i] = np.linalg.norm(vair[i])
+        np.subtract(v_i, surf_speed(r_i, nav), out=vair_i)
+        vairmag[i] = norm3_fast(vair_i)
         # angles
-        ang_p_srf[i] = get_angle_from_frame(vair[i], nav, 'pitch')
-        ang_y_srf[i] = get_angle_from_frame(vair[i], nav, 'yaw')
-        ang_p_obt[i] = get_angle_from_frame(v[i], nav, 'pitch')
-        ang_y_obt[i] = get_angle_from_frame(v[i], nav, 'yaw')
+        ang_p_srf[i] = get_angle_from_frame(vair_i, nav, 'pitch')
+        ang_y_srf[i] = get_angle_from_frame(vair_i, nav, 'yaw')
+        ang_p_obt[i] = get_angle_from_frame(v_i, nav, 'pitch')
+        ang_y_obt[i] = get_angle_from_frame(v_i, nav, 'yaw')
         # MASS&TIME
-        # Handle minor jettison events, if there are any.
-        js = len(jettison)
-        if js > 0:
-            for j in range(js):
-                # For each event check whether it hasn't been scheduled for
-                # a previous burn phase (its time set before the current
-                # phase begun). If this isn't checked, all older jettisons
-                # would be repeated in this phase.
-                # Then check whether it is already time to execute the event.
-                # Reduce the vehicle's mass by scheduled amount and set the
-                # event's time to negative (so that it never passes the
-                # first check again).
-                if jettison[j][0] < t[0]:
-                    continue
-                elif jettison[j][0] <= t[i]:
-                    m = m - jettison[j][1]
-                    jettison[j][0] = -1
+        # Handle minor jettison events, if there are any. Events are
+        # executed in order of their times, so only the next one needs to be
+        # checked. Reduce the vehicle's mass by scheduled amount and set the
+        # event's time to negative (so that it is not scheduled again by the
+        # following phases).
+        while jet_next < len(jet_order) and jettison[jet_order[jet_next]][0] <= t[i]:
+            j = jet_order[jet_next]
+            m = m - jettison[j][1]
+            jettison[j][0] = -1
+            jet_next = jet_next + 1
 
         # Added for integration with kRPC
         if apply_guidance_func is not None:
@@ -488,17 +524,18 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
 
     # OUTPUT
     # Trim all outputs for the actual duration of the flight.
-    plots = PlotEntry(t[0:i], r[0:i], rmag[0:i], v[0:i], vy[0:i], vt[0:i], vmag[0:i], 
-                      F[0:i], acc[0:i], q[0:i], pitch[0:i], yaw[0:i], vair[0:i], vairmag[0:i],
-                      ang_p_srf[0:i], ang_y_srf[0:i], ang_p_obt[0:i], ang_y_obt[0:i])
+    plots = PlotEntry(t[:i], r[:i], rmag[:i], v[:i], vy[:i], vt[:i], vmag[:i],
+                      F[:i], acc[:i], q[:i], pitch[:i], yaw[:i], vair[:i], vairmag[:i],
+                      ang_p_srf[:i], ang_y_srf[:i], ang_p_obt[:i], ang_y_obt[:i])
     # Add debug data if it was created, add a dummy struct otherwise (see
     # below comment on UPFG persistence).
     if dbg is not None:
+        _debug_finalize(dbg)
         plots.debug = dbg
     else:
         plots.debug = {}
     orbit = Orbit(0, 0, 0, 0, 0, 0)
-    results = Result((rmag[i-1]-R)/1000, 0, 0, orbit, vmag[i-1], np.vdot(v[i-1], nav[0]), np.vdot(v[i-1], rnc[2]), 
+    results = Result((rmag[i-1]-R)/1000, 0, 0, orbit, vmag[i-1], dot3(v[i-1], nav[0]), dot3(v[i-1], rnc[2]),
                      0, 0, g_loss, d_loss, g_loss+d_loss, maxT-t[i-1]+t[0], plots, eng)
     # Handle UPFG state persistence between stages. Turns out it is CRUCIAL
     # for multistage guidance capability.
@@ -520,39 +557,128 @@ def flight_sim_3d(vehicle, stage, initial, control, jettison, dt, apply_guidance
         results.orbit.ecc, results.orbit.inc, \
         results.orbit.lan, results.orbit.aop, \
         results.orbit.tan = get_orbital_elements(r[i-1], v[i-1])
-    # Get time and value of maxQ, format time to seconds.
-    results.max_Qt, results.max_Qv = get_max_value(q)
-    results.max_Qt = t[results.max_Qt]
+    # Get time and value of maxQ, format time to seconds. Step i is included
+    # (unlike in the plots) since it was fully computed if the loop ended on time.
+    max_Q_index = int(np.argmax(q[:i+1]))
+    results.max_Qv = q[max_Q_index]
+    results.max_Qt = t[max_Q_index]
     return results
 
 
+# converts initial conditions struct into the vehicle's time, position and
+# velocity; returns None if the struct is of unknown type
+def _initial_conditions(initial):
+    global R
+    if isinstance(initial, LaunchSite):     # launch from static site
+        r = np.array(sph2cart(np.deg2rad(initial.longitude), np.deg2rad(initial.latitude), R+initial.altitude))
+        v = surf_speed(r, get_navball_frame(r, np.zeros((3, 3))))
+        return 0, r, v
+    elif isinstance(initial, InitStruct):   # vehicle already in flight
+        return initial.t, initial.r, initial.v
+    return None
+
+
+# prepares UPFG for a guided phase, given the physical state of the vehicle
+# and the initial conditions struct the phase was started with; returns the
+# results of the converged UPFG call (internal state, guidance, debug)
+def _init_upfg(vehicle, target, state, initial):
+    global mu
+    internal = None
+    # Check if the stage continues an already started UPFG routine.
+    # If so, verify if the routine contains necessary fields (just
+    # checks for 'tgo', assuming an erroneous struct will be empty or
+    # contain just garbage).
+    if isinstance(initial, InitStruct) and initial.upfg is not None \
+        and isinstance(initial.upfg, upfg.UPEGState):
+        # If the struct is okay, use it as initialization for the
+        # current stage and reconverge UPFG. This helps avoid some
+        # guidance oscillation after coast phases.
+        internal = initial.upfg
+        internal.tb = 0
+        internal, guidance, debug = converge_upfg(vehicle, target, state, internal, 0, 50)
+    # If no initial state was found, a new one must be built and converged.
+    if internal is None:
+        # Guidance initialization: project initial position direction unit
+        # vector onto target plane, rotate with Rodrigues' formula about
+        # 20 degrees prograde and extend to target length, finally calculate
+        # velocity at this point.
+        r = state.radius
+        v = state.velocity
+        rdinit = rodrigues(unit(r), -target.normal, 20)
+        rdinit = rdinit * target.radius
+        vdinit = target.velocity*unit(np.cross(-target.normal, rdinit))
+        vdinit = vdinit - v
+        cser = upfg.CSERState(0, 0, 0, 0, 0)
+        internal = upfg.UPEGState(cser, np.array([0, 0, 0]), rdinit,
+                                  -(mu/2)*r/norm3(r)**3,
+                                  0, state.time, 0, v, vdinit)
+        internal, guidance, debug = converge_upfg(vehicle, target, state, internal, state.time, 50)
+    return internal, guidance, debug
+
+
+# enlarges preallocated simulation logs to n steps, keeping their contents
+def _grow(n, *logs):
+    grown = []
+    for log in logs:
+        new_log = np.zeros((n,) + log.shape[1:])
+        new_log[:len(log)] = log
+        grown.append(new_log)
+    return grown
+
+
+# advances the vehicle's position and velocity by a single step of length dt
+# under thrust acceleration acv, gravity G and drag D (opposing vair), writing
+# into r_out and v_out; equivalent to
+#     v_out = v + acv*dt - G*dt - D*unit(vair)*dt
+#     r_out = r + v_out*dt
+# but computed per component, without a temporary array for each term
+def _integrate_step(r, v, acv, G, D, vair, dt, r_out, v_out):
+    ax, ay, az = acv.tolist()
+    gx, gy, gz = G.tolist()
+    wx, wy, wz = vair.tolist()
+    norm = norm3_fast(vair)
+    if norm != 0:
+        wx, wy, wz = wx/norm, wy/norm, wz/norm
+    vx, vy, vz = v.tolist()
+    vx = vx + ax*dt - gx*dt - D*wx*dt
+    vy = vy + ay*dt - gy*dt - D*wy*dt
+    vz = vz + az*dt - gz*dt - D*wz*dt
+    rx, ry, rz = r.tolist()
+    r_out[0] = rx + vx*dt
+    r_out[1] = ry + vy*dt
+    r_out[2] = rz + vz*dt
+    v_out[0] = vx
+    v_out[1] = vy
+    v_out[2] = vz
+
+
 # constructs a local reference frame, KSP-navball style
-def get_navball_frame(r):
+def get_navball_frame(r, out):
     # pass current position under r (1x3)
-    up = unit(r)                       # true Up direction (radial away from Earth)
-    east = np.cross(np.array([0, 0, 1]), up)  # true East direction
-    north = np.cross(up, east)              # true North direction (completes frame)
-    f = [None]*3
+    # the frame is written into out (3x3) and returned
+    up, north, east = out
+    up[:] = r
+    normalize3(up)                # true Up direction (radial away from Earth)
+    cross3(_Z_AXIS, up, east)     # true East direction
+    cross3(up, east, north)       # true North direction (completes frame)
     # return a right-handed coordinate system base
-    f[0] = up
-    f[1] = unit(north)
-    f[2] = unit(east)
-    return f
+    normalize3(north)
+    normalize3(east)
+    return out
 
 
 # constructs a local reference frame in style of PEG coordinate base
-def get_circum_frame(r, v):
+def get_circum_frame(r, v, out):
     # pass current position under r (1x3)
     # current velocity under v (1x3)
-    radial = unit(r)                   # Up direction (radial away from Earth)
-    normal = unit(np.cross(r, v))      # Normal direction (perpendicular to orbital plane)
-    circum = np.cross(normal, radial)  # Circumferential direction (tangential to sphere, in motion plane)
-    f = [None]*3
+    # the frame is written into out (3x3) and returned
+    radial, normal, circum = out
+    radial[:] = r
+    normalize3(radial)                     # Up direction (radial away from Earth)
+    normalize3(cross3(r, v, normal))       # Normal direction (perpendicular to orbital plane)
+    cross3(normal, radial, circum)         # Circumferential direction (tangential to sphere, in motion plane)
     # return a left(?)-handed coordinate system base
-    f[0] = radial
-    f[1] = normal
-    f[2] = circum
-    return f
+    return out
 
 
 # finds rotation angle between the two frames
@@ -568,18 +694,35 @@ def rnc2nav(rnc, nav):
 # understanding frame as a 3x3 matrix of vectors 'up', 'north', 'east',
 # rotates the 'up' vector towards the 'east' by 'p' degrees (pitch), and
 # then rotates this about the 'up' axis by 'y' degrees towards 'north' (yaw)
-def make_vector(frame, p, y):
-    v = rodrigues(frame[0], frame[1], p)
-    v = rodrigues(v, frame[0], y)
-    return v
+# the vector is written into out (1x3) and returned
+def make_vector(frame, p, y, out):
+    return _frame_combination(frame, _make_vector_coefficients(p, y), out)
+
+
+# coefficients of the 'up', 'north' and 'east' vectors for make_vector; both
+# rotations composed analytically (frame is orthonormal), which gives
+#     up*cos(p) + (north*sin(y) + east*cos(y))*sin(p)
+def _make_vector_coefficients(p, y):
+    p = math.radians(p)
+    y = math.radians(y)
+    return math.cos(p), math.sin(y)*math.sin(p), math.cos(y)*math.sin(p)
+
+
+# writes the combination of the frame vectors with the given coefficients
+# into out (1x3) and returns it
+def _frame_combination(frame, coefficients, out):
+    c_up, c_north, c_east = coefficients
+    up, north, east = frame.tolist()
+    out[0] = up[0]*c_up + north[0]*c_north + east[0]*c_east
+    out[1] = up[1]*c_up + north[1]*c_north + east[1]*c_east
+    out[2] = up[2]*c_up + north[2]*c_north + east[2]*c_east
+    return out
 
 
 # finds Earth's rotation velocity vector at given cartesian location
 def surf_speed(r, nav):
-    global R
-    global period
-    _, lat, _ = cart2sph(r[0], r[1], r[2])
-    vel = 2*np.pi*R/period * np.cos(lat)
+    global OMEGA_R
+    vel = OMEGA_R * math.cos(_latitude(r))
     rot = vel*nav[2]  # third componend is East vector
     return rot
 
@@ -588,20 +731,46 @@ def surf_speed(r, nav):
 # pass expected length of the vector (number of guidance iterations, usually
 # maxT / guidance cycle + 5 should be okay)
 def debug_initializator(n):
-    return upfg.DebugState(0, GrowingList(0), GrowingList([0]*4), GrowingList([0]*4), GrowingList(0),
-                           GrowingList([0]*4), GrowingList([0]*4),
-                           GrowingList(0), GrowingList(0), GrowingList(0), GrowingList(0), GrowingList(0),
-                           GrowingList(0), GrowingList(0), GrowingList(0),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4),
-                           GrowingList([0]*4), GrowingList(0),
-                           GrowingList([0]*4), GrowingList(0), GrowingList([0]*4),
-                           GrowingList([0]*4), GrowingList(0), GrowingList(0), GrowingList([0]*4), GrowingList([0]*4),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList(0), GrowingList([0]*4), GrowingList(0),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4) ,GrowingList([0]*4),
-                           GrowingList(0), GrowingList(0), GrowingList(0), GrowingList(0), GrowingList(0),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4), GrowingList([0]*4),
-                           GrowingList([0]*4), GrowingList([0]*4), GrowingList(0))
+    def scalar():
+        return np.zeros(n)
+    def vector():
+        return np.zeros((n, 4))  # XYZ and magnitude
+    return upfg.DebugState(0, scalar(), vector(), vector(), scalar(),
+                           vector(), vector(),
+                           scalar(), scalar(), scalar(), scalar(), scalar(),
+                           scalar(), scalar(), scalar(),
+                           vector(), vector(), vector(), vector(),
+                           vector(), scalar(),
+                           vector(), scalar(), vector(),
+                           vector(), scalar(), scalar(), vector(), vector(),
+                           vector(), vector(), scalar(), vector(), scalar(),
+                           vector(), vector(), vector() ,vector(),
+                           scalar(), scalar(), scalar(), scalar(), scalar(),
+                           vector(), vector(), vector(), vector(),
+                           vector(), vector(), vector(), vector(),
+                           vector(), vector(), scalar())
+
+# trims or extends (with zeros) all logs of the debug data aggregator to n entries
+def _debug_resize(a, n):
+    for name in ('time', 'tgo', 'diverge') + _DEBUG_SCALARS + _DEBUG_VECTORS:
+        log = getattr(a, name)
+        if n <= len(log):
+            setattr(a, name, log[:n])
+        else:
+            setattr(a, name, _grow(n, log)[0])
+
+
+# UPFG debug fields archived by debug_aggregator, beyond the time, tgo and
+# diverge logs it always keeps. Vectors are logged as XYZ and magnitude, the
+# latter filled in for all entries at once by _debug_finalize.
+_DEBUG_SCALARS = ('m', 'L1', 'L', 'J', 'S', 'Q', 'P', 'H', 'rgoz', 'lambdade',
+                  'phi', 'phidot', 'pitch', 'yaw',
+                  'cser_dtcp', 'cser_xcp', 'cser_A', 'cser_D', 'cser_E')
+_DEBUG_VECTORS = ('r', 'v', 'dvsensed', 'vgo1', 'lambda_vec', 'rgrav1', 'rgo1',
+                  'iz1', 'rgoxy', 'rgo2', 'lambdadot', 'iF', 'vthrust', 'rthrust',
+                  'vbias', 'rbias', 'EAST', 'rc1', 'vc1', 'rc2', 'vc2', 'vgrav',
+                  'rgrav2', 'rp', 'rd', 'ix', 'iz2', 'vd', 'vgop', 'dvgo', 'vgo2')
+
 
 # handles UPFG debug data aggregating
 # adds debug data from a single guidance iteration into aggregated, time-based
@@ -611,107 +780,56 @@ def debug_aggregator(a, d):
     # we must know where to put the new results
     i = a.this
     a.this = i+1
-    # and onto the great copy...
+    # guidance may be called more often than expected, make room if needed
+    if i == len(a.time):
+        _debug_resize(a, 2*i)
     a.time[i] = d.time
-    a.r[i][0:3] = d.r
-    a.r[i][3] = np.linalg.norm(d.r)
-    a.v[i][0:3] = d.v
-    a.v[i][3] = np.linalg.norm(d.v)
-    a.m[i] = d.m
-    a.dvsensed[i][0:3] = d.dvsensed
-    a.dvsensed[i][3] = np.linalg.norm(d.dvsensed)
-    a.vgo1[i][0:3] = d.vgo1
-    a.vgo1[i][3] = np.linalg.norm(d.vgo1)
-    a.L1[i] = d.L1
     a.tgo[i] = d.tgo
-    a.L[i] = d.L
-    a.J[i] = d.J
-    a.S[i] = d.S
-    a.Q[i] = d.Q
-    a.P[i] = d.P
-    a.H[i] = d.H
-    a.lambda_vec[i][0:3] = d.lambda_vec
-    a.lambda_vec[i][3] = np.linalg.norm(d.lambda_vec)
-    a.rgrav1[i][0:3] = d.rgrav1
-    a.rgrav1[i][3] = np.linalg.norm(d.rgrav1)
-    a.rgo1[i][0:3] = d.rgo1
-    a.rgo1[i][3] = np.linalg.norm(d.rgo1)
-    a.iz1[i][0:3] = d.iz1
-    a.iz1[i][3] = np.linalg.norm(d.iz1)
-    a.rgoxy[i][0:3] = d.rgoxy
-    a.rgoxy[i][3] = np.linalg.norm(d.rgoxy)
-    a.rgoz[i] = d.rgoz
-    a.rgo2[i][0:3] = d.rgo2
-    a.rgo2[i][3] = np.linalg.norm(d.rgo2)
-    a.lambdade[i] = d.lambdade
-    a.lambdadot[i][0:3] = d.lambdadot
-    a.lambdadot[i][3] = np.linalg.norm(d.lambdadot)
-    a.iF[i][0:3] = d.iF
-    a.iF[i][3] = np.linalg.norm(d.iF)
-#    a.phi(i) = d.phi;
-#    a.phidot(i) = d.phidot;
-#    a.vthrust(i,1:3) = d.vthrust;
-#    a.vthrust(i,4) = norm(d.vthrust);
-#    a.rthrust(i,1:3) = d.rthrust;
-#    a.rthrust(i,4) = norm(d.rthrust);
-#    a.vbias(i,1:3) = d.vbias;
-#    a.vbias(i,4) = norm(d.vbias);
-#    a.rbias(i,1:3) = d.rbias;
-#    a.rbias(i,4) = norm(d.rbias);
-#    a.pitch(i) = d.pitch;
-#    a.EAST(i,1:3) = d.EAST;
-#    a.EAST(i,4) = norm(d.EAST);
-#    a.yaw(i) = d.yaw;
-#    a.rc1(i,1:3) = d.rc1;
-#    a.rc1(i,4) = norm(d.rc1);
-#    a.vc1(i,1:3) = d.vc1;
-#    a.vc1(i,4) = norm(d.vc1);
-#    a.rc2(i,1:3) = d.rc2;
-#    a.rc2(i,4) = norm(d.rc2);
-#    a.vc2(i,1:3) = d.vc2;
-#    a.vc2(i,4) = norm(d.vc2);
-#    a.cser_dtcp(i) = d.cser.dtcp;
-#    a.cser_xcp(i) = d.cser.xcp;
-#    a.cser_A(i) = d.cser.A;
-#    a.cser_D(i) = d.cser.D;
-#    a.cser_E(i) = d.cser.E;
-#    a.vgrav(i,1:3) = d.vgrav;
-#    a.vgrav(i,4) = norm(d.vgrav);
-#    a.rgrav2(i,1:3) = d.rgrav2;
-#    a.rgrav2(i,4) = norm(d.rgrav2);
-#    a.rp(i,1:3) = d.rp;
-#    a.rp(i,4) = norm(d.rp);
-#    a.rd(i,1:3) = d.rd;
-#    a.rd(i,4) = norm(d.rd);
-#    a.ix(i,1:3) = d.ix;
-#    a.ix(i,4) = norm(d.ix);
-#    a.iz2(i,1:3) = d.iz2;
-#    a.iz2(i,4) = norm(d.iz2);
-#    a.vd(i,1:3) = d.vd;
-#    a.vd(i,4) = norm(d.vd);
-#    a.vgop(i,1:3) = d.vgop;
-#    a.vgop(i,4) = norm(d.vgop);
-#    a.dvgo(i,1:3) = d.dvgo;
-#    a.dvgo(i,4) = norm(d.dvgo);
-#    a.vgo2(i,1:3) = d.vgo2;
-#    a.vgo2(i,4) = norm(d.vgo2);
     a.diverge[i] = d.diverge
+    if not DEBUG_FULL:
+        return a
+    # and onto the great copy...
+    for name in _DEBUG_SCALARS:
+        getattr(a, name)[i] = getattr(d, name)
+    for name in _DEBUG_VECTORS:
+        getattr(a, name)[i, 0:3] = getattr(d, name)
     return a
 
-# handles UPFG convergence by running it in loop until tgo stabilizes
-def converge_upfg(vehicle, target, state, internal, time, max_iters):
-    global convergence_criterion
-    fail = 1
-    internal, guidance, debug = upfg.unified_powered_flight_guidance(vehicle, target, state, internal)
+# trims the debug data aggregator to the entries actually used and computes
+# the magnitude column of every archived vector log
+def _debug_finalize(a):
+    _debug_resize(a, a.this)
+    if not DEBUG_FULL:
+        return
+    for name in _DEBUG_VECTORS:
+        log = getattr(a, name)
+        xyz = log[:, 0:3]
+        log[:, 3] = np.sqrt(np.einsum('ij,ij->i', xyz, xyz))
+
+# handles UPFG convergence by running it in loop until tgo stabilizes, or
+# until the commanded thrust direction has held still for two iterations
+# the tgo of the incoming internal struct seeds the first comparison (a fresh
+# struct has tgo=0, which the absolute floor of the tolerance keeps harmless)
+def converge_upfg(vehicle, target, state, internal, time, max_iters, tol=CONVERGENCE_CRITERION):
+    t2 = internal.tgo
+    iF = None
+    steady = 0
+    i = -1
+    guidance = debug = None
     for i in range(max_iters):
-        t1 = internal.tgo
+        t1 = t2
         internal, guidance, debug = upfg.unified_powered_flight_guidance(vehicle, target, state, internal)
         t2 = internal.tgo
-        if abs((t1-t2)/t1) < convergence_criterion:
-            if time > 0:
-                print('UPFG converged after %d iterations, predicted insertion time: T+%.1fs (tgo=%.1f).' % (i, time+t2, t2))
-            fail = 0
-            break
-    if fail:
-        print('UPFG failed to converge in %d iterations!' % i)
+        # both are unit vectors, so this is already a relative change
+        if iF is not None and norm3_fast(debug.iF - iF) < tol:
+            steady = steady + 1
+        else:
+            steady = 0
+        iF = debug.iF
+        if abs(t1-t2) < tol*max(abs(t1), 1.0) or steady == 2:
+            if DEBUG_UPFG and time > 0:
+                print('UPFG converged after %d iterations, predicted insertion time: T+%.1fs (tgo=%.1f).' % (i+1, time+t2, t2))
+            return internal, guidance, debug
+    # only reached if UPFG did not converge
+    print('UPFG failed to converge in %d iterations!' % (i+1))
     return internal, guidance, debug
@@ -1,5 +1,7 @@
+import math
 import numpy as np
 from unit import unit
+from vector_tools import cross3
 
 
 def get_angle_from_frame(vector, frame, type):
@@ -24,7 +26,7 @@ def get_angle_from_frame(vector, frame, type):
         inplane = unit(inplane)
         angle = safe_acosd(np.vdot(inplane, frame[2]))
         # correct for direction of the angle
-        tangential = np.cross(frame[0], frame[2])
+        tangential = cross3(frame[0], frame[2])
         if np.vdot(inplane, tangential) < 0:
             angle = -angle
     else:
@@ -45,5 +47,5 @@ def safe_acosd(angle):
     """
     angle = min(angle,  1)
     angle = max(angle, -1)
-    a = np.rad2deg(np.arccos(angle))
+    a = math.degrees(math.acos(angle))
     return a
@@ -1,7 +1,6 @@
+import numpy as np
 import init_simulation
 
-from approx_from_curve import approx_from_curve
-
 g0 = init_simulation.g0
 
 
@@ -32,7 +31,8 @@ def get_thrust(engines, pressure, time):
         if engines[i].mode == 1:
             dm_ = engines[i].flow
         elif engines[i].mode == 2:
-            dm_ = approx_from_curve(t, engines[i].data) * engines[i].flow
+            profile_t, profile_portion = engines[i].profile
+            dm_ = np.interp(t, profile_t, profile_portion) * engines[i].flow
 
         dm = dm + dm_
         F = F + isp*dm_*g0
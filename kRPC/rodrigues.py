@@ -1,3 +1,4 @@
+import math
 import numpy as np
 from unit import unit
 
@@ -15,7 +16,10 @@ def rodrigues(vector, axis, angle):
     :return: Rotated XYZ vector.
     """
     axis = unit(axis);
-    rotated = vector*np.cos(np.deg2rad(angle))
-    rotated = rotated + np.cross(axis, vector)*np.sin(np.deg2rad(angle))
-    rotated = rotated + axis*np.vdot(axis,vector)*(1-np.cos(np.deg2rad(angle)))
+    # scalar trigonometry through math, numpy ufuncs are slow on single floats
+    cos_a = math.cos(math.radians(angle))
+    sin_a = math.sin(math.radians(angle))
+    rotated = vector*cos_a
+    rotated = rotated + np.cross(axis, vector)*sin_a
+    rotated = rotated + axis*np.vdot(axis,vector)*(1-cos_a)
     return rotated
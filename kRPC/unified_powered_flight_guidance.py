@@ -1,3 +1,4 @@
+import math
 import numpy as np
 import init_simulation
 from conic_state_extrapolation_routine import conic_state_extrapolation_routine, CSERState
@@ -5,6 +6,7 @@ from get_angle_from_frame import get_angle_from_frame
 from get_thrust import get_thrust
 from rodrigues import rodrigues
 from unit import unit
+from vector_tools import cross3
 
 g0 = init_simulation.g0
 
@@ -20,7 +22,10 @@ class Target:
         self.velocity = velocity  # magnitude of the velocity
 
 
-class State:
+class State(object):
+    # Rewritten by flight_sim_3d on every guidance cycle, so keep attribute access cheap
+    __slots__ = ('time', 'mass', 'radius', 'velocity')
+
     def __init__(self, time, mass, radius, velocity):
         self.time = float(time)
         self.mass = float(mass)
@@ -83,6 +88,11 @@ class VehicleEngine:
         self.flow = float(flow)  # maximum flow rate in kg/s
         self.data = data         # a list containing the min and max throttle settings (mode 1)
                                  # or a list of lists with time and thrust portion (mode 2)
+        self.profile = None      # for mode 2, the thrust profile as a pair of arrays (time, thrust
+                                 # portion), as used by get_thrust
+        if mode == 2 and data is not None:
+            profile = np.array(data, dtype=float)
+            self.profile = (profile[:, 0], profile[:, 1])
 
     def clone(self):
         data = None
@@ -263,24 +273,25 @@ def unified_powered_flight_guidance(vehicle, target, state, previous):
     tu[0] = ve[0] / aT[0]
     L = 0
     Li = [0]*n
+    vgo_norm = np.linalg.norm(vgo)
     for i in range(n-1):
         if SM[i] == 1:
-            Li[i] = ve[i]*np.log(tu[i] / (tu[i]-tb[i]))
+            Li[i] = ve[i]*math.log(tu[i] / (tu[i]-tb[i]))
         elif SM[i] == 2:
             Li[i] = aL[i]*tb[i]
 
         L = L + Li[i]
         # If we have more stages than we need to get to orbit, redo the
         # whole calculation but skip the last stage.
-        if L > np.linalg.norm(vgo):
+        if L > vgo_norm:
             return unified_powered_flight_guidance(vehicle[0:n-1], target, state, previous)
-    Li[n-1] = np.linalg.norm(vgo) - L
+    Li[n-1] = vgo_norm - L
     # Now for each stage its remaining time of burn is calculated (tbi) and
     # in the same pass accumulated into a total time-to-go of the maneuver.
     tgoi = [0]*n  # Time-to-go until end of ith phase
     for i in range(n):
         if SM[i] == 1:
-            tb[i] = tu[i]*(1-np.exp(-Li[i]/ve[i]))
+            tb[i] = tu[i]*(1-math.exp(-Li[i]/ve[i]))
         elif SM[i] == 2:
             tb[i] = Li[i] / aL[i]
         if i == 0:
@@ -341,11 +352,11 @@ def unified_powered_flight_guidance(vehicle, target, state, previous):
     lambda_vec = unit(vgo)     # Unit vector in direction of vgo
     # print('lambda %s; vgo = %s' % (lambda_vec, vgo))
     rgrav1 = rgrav
-    if not np.isclose(previous.tgo, 0):
+    if abs(previous.tgo) > 1e-8:
        rgrav = (tgo/previous.tgo)**2 * rgrav
     rgo = rd - (r + v*tgo + rgrav)
     rgo1 = rgo
-    iz = unit(np.cross(rd, iy))
+    iz = unit(cross3(rd, iy))
     # print('iz = %s; rd = %s; iy = %s' % (iz, rd, iy))
     iz1 = iz
     rgoxy = rgo - np.vdot(iz, rgo)*iz
@@ -368,7 +379,7 @@ def unified_powered_flight_guidance(vehicle, target, state, previous):
     # TODO - pitch and yaw RATES
     UP = unit(r)
     NORTH = np.array([0, 0, 1])
-    EAST = unit(np.cross(NORTH, UP))
+    EAST = unit(cross3(NORTH, UP))
     frame = [UP, NORTH, EAST]
     # print('Frame: %s; iF = %s' % (frame, iF))
     pitch = get_angle_from_frame(iF, frame, 'pitch')
@@ -389,8 +400,8 @@ def unified_powered_flight_guidance(vehicle, target, state, previous):
     rp = rp - np.vdot(rp, iy)*iy
     rd = rdval*unit(rp)
     ix = unit(rd)
-    iz = np.cross(ix, iy)
-    vd = vdval*np.matmul(np.transpose([ix, iy, iz]), [np.sin(gamma), 0, np.cos(gamma)])
+    iz = cross3(ix, iy)
+    vd = vdval*(math.sin(gamma)*ix + math.cos(gamma)*iz)
     vgop = vd - v - vgrav + vbias
     dvgo = rho*(vgop-vgo)  # big values (0.8+) cause bananas; standard ascent uses 0 (?)
     # print('vd = %s; gamma = %f; vgop = %s; v = %s; vgrav = %s; vbias = %s' % (vd, gamma, vgop, v, vgrav, vbias))
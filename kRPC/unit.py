@@ -8,7 +8,8 @@ def unit(vector):
     :param vector: Any valid XYZ vector.
     :return: Vector of the same direction as v but of magnitude 1.
     """
-    if np.linalg.norm(vector) == 0:
+    norm = np.linalg.norm(vector)
+    if norm == 0:
         return vector
     else:
-        return vector/np.linalg.norm(vector)
+        return vector/norm
@@ -0,0 +1,79 @@
+import math
+import numpy as np
+
+
+# Helper functions for single XYZ vectors (ndarrays). NumPy's own routines
+# (np.linalg.norm, np.cross, ...) spend far more time on call overhead than on
+# the arithmetic for arrays this small, so the components are unpacked into
+# Python floats and the math is written out.
+
+
+def norm3(a):
+    """
+    Magnitude of a vector, computed with math.hypot so it neither overflows
+    nor underflows.
+
+    :param a: XYZ vector.
+    :return: Magnitude of a.
+    """
+    x, y, z = a.tolist()
+    return math.hypot(math.hypot(x, y), z)
+
+
+def norm3_fast(a):
+    """
+    Magnitude of a vector as the plain square root of the sum of squares. Use
+    for vectors known to be well scaled (anything in the simulation's range of
+    positions and velocities).
+
+    :param a: XYZ vector.
+    :return: Magnitude of a.
+    """
+    x, y, z = a.tolist()
+    return math.sqrt(x*x + y*y + z*z)
+
+
+def dot3(a, b):
+    """
+    Dot product of two vectors.
+
+    :param a: XYZ vector.
+    :param b: XYZ vector.
+    :return: Dot product of a and b.
+    """
+    ax, ay, az = a.tolist()
+    bx, by, bz = b.tolist()
+    return ax*bx + ay*by + az*bz
+
+
+def cross3(a, b, out=None):
+    """
+    Cross product of two vectors.
+
+    :param a: XYZ vector.
+    :param b: XYZ vector.
+    :param out: Optional XYZ vector to write the result into.
+    :return: Cross product of a and b (out, if it was given).
+    """
+    ax, ay, az = a.tolist()
+    bx, by, bz = b.tolist()
+    if out is None:
+        return np.array([ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx])
+    out[0] = ay*bz - az*by
+    out[1] = az*bx - ax*bz
+    out[2] = ax*by - ay*bx
+    return out
+
+
+def normalize3(a):
+    """
+    Scales a vector to unit length in place. Like unit(), leaves a zero vector
+    as it is.
+
+    :param a: XYZ vector (modified).
+    :return: a.
+    """
+    norm = norm3_fast(a)
+    if norm != 0:
+        a /= norm
+    return a